@@ -13,3 +13,10 @@ cd python-omxplayer-wrapper
 sudo python3 setup.py install
 sudo python3 -m pip install mock
 cd ..
+# Photo ingest: Pillow renders the photos, ffmpeg converts them into clips
+sudo apt-get install -y python3-pil ffmpeg
+# Overlays: libbcm_host drives the dispmanx layer above the countdown video
+if ! sudo apt-get install -y libraspberrypi0; then
+    echo "ERROR: libraspberrypi0 (libbcm_host) couldn't be installed"
+    exit 1
+fi
@@ -34,10 +34,30 @@
 
 import time, random
 import os      # getpid(): Get current process id
-import sys     # argv[], exitcode
+import sys     # argv[], exitcode, _current_frames()
+import signal  # SIGUSR1/SIGUSR2: control the sampling profiler
+import threading  # background thread of the photo ingest
+import hashlib    # content hash of ingested photos
+import io         # RawIOBase: JPEG previews embedded in RAW photos
+import shutil     # rmtree(): evict photo cache entries
+import subprocess # ffmpeg: render photo clips
+import concurrent.futures.process # process pool of the photo ingest
+import multiprocessing # start method of the photo ingest workers
+import ctypes     # dispmanx layer of the overlays
+import ctypes.util
 #from omxplayer.player import OMXPlayer
 import omxplayer.player
 import gpiozero
+import photomat_stats
+try:
+    # Pillow is optional. Without it the photo ingest and the overlays
+    # are disabled:
+    import PIL.Image
+    import PIL.ImageOps
+    import PIL.ImageDraw
+    import PIL.ImageFont
+except ImportError:
+    PIL = None
 
 
 OMXINSTANCE_ERR_NO_VIDEO = -2 # No video defined for idle/applause
@@ -47,6 +67,7 @@ OMXINSTANCE_IDLE2 = 1
 OMXINSTANCE_CNTDN = 2 # Countdown
 ####OMXINSTANCE_APPL = 3 # Applause
 OMXLAYER = [2, 1, 3]
+OMXLAYER_OVERLAY = 4 # dispmanx layer above OMXLAYER[OMXINSTANCE_CNTDN]
 
 VID_INDEX = 0
 VID_FILENAM = 1
@@ -56,6 +77,61 @@ FADETIME_IDLE_END = 0.75
 FADETIME_CNTDN_START = 0.75
 FADETIME_CNTDN_END = 0.75
 
+# Latency between calling play() and the first frame on the screen.
+# It is learned for each player backend while the videos are played:
+PLAY_LATENCY_DEFAULT = 0.06 # seconds, used until the first measurement
+PLAY_LATENCY_MAX = 1.0 # longer measurements are ignored
+PLAY_LATENCY_WEIGHT = 0.2 # weight of a new measurement
+
+PHOTO_NONE = 0         # Ingested photos aren't shown
+PHOTO_REPLACE_APPL = 1 # Latest photo is shown instead of the applause video
+PHOTO_AFTER_APPL = 2   # Latest photo is shown after the applause video
+
+PHOTO_SEQNO = 0
+PHOTO_FILENAM = 1
+PHOTO_CLIP = 2
+PHOTO_ARRIVAL = 3 # time.time() when the photo file has appeared
+
+# RAW photos can't be decoded by Pillow. Their embedded JPEG preview is used:
+PHOTO_EXTENSIONS_RAW = ['.cr2', '.nef', '.arw', '.dng']
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.tif', '.tiff'] \
+                   + PHOTO_EXTENSIONS_RAW
+# Only JPEG photos are scaled down while decoding. Others are decoded at
+# full size, so their size and the number of workers are limited:
+PHOTO_MAX_PIXELS = 40 * 1000 * 1000
+PHOTO_WORKERS_MAX = 2
+PHOTO_SIZE_THUMB = (320, 180)
+PHOTO_SIZE_DISPLAY = (1920, 1080) # TODO: read resolution from system
+PHOTO_CLIP_DURATION = 8
+PHOTO_WAIT_TIMEOUT = 5 # seconds to wait for the shot after the countdown
+
+# Overlays shown above the countdown video:
+OVL_START = 0 # playback position in seconds (negative: before the end)
+OVL_END = 1
+OVL_TEXT = 2
+OVL_IMAGE = 3 # image file name or None
+OVL_FONT = 4 # TrueType font file name
+OVL_SIZE = 5 # font size in pixels
+OVL_GEOMETRY = 6 # 'x1,y1,x2,y2' like the --win option of omxplayer
+
+OVERLAY_DISPLAY = 0 # dispmanx display number like omxplayer's --display
+OVERLAY_FONT = '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'
+
+# dispmanx constants from the Raspberry Pi userland headers:
+VC_IMAGE_RGBA32 = 15
+DISPMANX_FLAGS_ALPHA_FROM_SOURCE = 0
+DISPMANX_FLAGS_ALPHA_MIX = 1 << 17 # per-pixel alpha times opacity
+DISPMANX_PROTECTION_NONE = 0
+DISPMANX_NO_ROTATE = 0
+DISPMANX_ELEMENT_CHANGE_OPACITY = 1 << 1
+
+PROFILE_INTERVAL = 0.005 # sampling interval of the profiler in seconds
+PROFILE_IDLE_POLL = 0.1 # polling interval of the signal flags in seconds
+PROFILE_DUMPDIR = '/tmp' # directory of the collapsed stack files
+PROFILE_TARGETS = ['StateMachine.manage_players',
+                   'VideoPlayer.fade',
+                   'VideoPlayer.set_alpha',
+                   'VideoPlayer.load_omxplayer'] # and all state handlers
 
 STATE_EXIT = 0
 STATE_ERROR = 1
@@ -107,8 +183,15 @@ class VideoPlayer:
         self.last_alpha = 0
         
         self.omxplayer = None
+        self.backend = 'omxplayer' # key of the learned play latency
+        self.filenam = None
+        self.role = None # photomat_stats.ROLE_xxx of the loaded video
         self.duration = 0 # < 0: An error occurred when examining the duration
         self.position = 0
+        self.position_time = 0 # time.monotonic() of self.position
+        self.start_time = None # time.monotonic() of position 0 (predicted)
+        self.play_time = None # time.monotonic() when play() was due
+        self.latency_sample = None # measured play latency in seconds
         self.playback_status = 'None'
         self.is_fading = False
 
@@ -118,6 +201,8 @@ class VideoPlayer:
             self.omxplayer.quit()
             self.omxplayer = None
             self.playback_status = 'None'
+            self.start_time = None
+            self.play_time = None
             ret = 0
         else:
             # The omxplayer instance was already removed:
@@ -142,6 +227,7 @@ class VideoPlayer:
                 ret = 1
             else:
                 ret = 0
+                self.filenam = filenam
                 self.last_alpha = 0
                 try:
                     # store video sequence duration in the class property
@@ -163,7 +249,10 @@ class VideoPlayer:
             self.playback_status = 'None'
         else:
             try:
+                time_called = time.monotonic()
                 self.position = self.omxplayer.position()
+                # The position refers to the middle of the D-Bus round trip:
+                self.position_time = (time_called + time.monotonic()) / 2
             except Exception as e:
                 self.position = -1
                 self.playback_status = 'Exception {}: {}'.format(
@@ -177,8 +266,46 @@ class VideoPlayer:
                     self.playback_status = 'Exception {}: {}'.format(
                                            str(type(e)),
                                            str(e.args[0]))
+                else:
+                    self.updt_start_time()
         return self.playback_status
 
+    def updt_start_time(self):
+        # Each polled position predicts the time when the video has been
+        # started. Averaging them smoothes the jitter of the D-Bus calls:
+        if self.playback_status != 'Playing' or self.position <= 0:
+            return
+        start_time = self.position_time - self.position
+        if self.start_time is None or abs(start_time - self.start_time) > 0.1:
+            # first position after play() or the video has been seeked:
+            self.start_time = start_time
+        else:
+            self.start_time += 0.25 * (start_time - self.start_time)
+        if self.play_time is not None:
+            self.latency_sample = self.start_time - self.play_time
+            self.play_time = None
+
+    def predicted_position(self, now):
+        if self.playback_status == 'Playing' and self.start_time is not None:
+            return now - self.start_time
+        return self.position
+
+    def predicted_end(self):
+        # Returns time.monotonic() when the video will end
+        # or None if it isn't playing:
+        if self.playback_status == 'Playing' and self.start_time is not None:
+            return self.start_time + self.duration
+        return None
+
+    def play(self, play_time=None):
+        # play_time: the time when play() was scheduled. The latency
+        # measured from there includes the delays of the state machine.
+        self.play_time = time.monotonic() if play_time is None else play_time
+        self.start_time = None
+        self.omxplayer.set_position(0)
+        self.set_alpha(self.alpha_start)
+        self.omxplayer.play()
+
     def set_alpha(self, alpha):
         # Check if change of alpha value is really necessary:
         if alpha < 0: alpha = 0
@@ -251,6 +378,740 @@ class VideoPlayer:
 
 
 
+class TransitionPlanner:
+    def __init__(self):
+        self.latency = {} # backend: learned play latency in seconds
+
+    def get_latency(self, backend):
+        return self.latency.get(backend, PLAY_LATENCY_DEFAULT)
+
+    def learn(self, backend, latency):
+        if 0 <= latency <= PLAY_LATENCY_MAX:
+            if backend in self.latency:
+                self.latency[backend] += PLAY_LATENCY_WEIGHT \
+                                         * (latency - self.latency[backend])
+            else:
+                self.latency[backend] = latency
+            print_verbose('    play latency of {}: {:.3f}s (learned {:.3f}s) '
+                          .format(backend, latency, self.latency[backend]),
+                          VERBOSE_VIDEOINFO)
+
+    def play_time(self, pl_running, pl_next):
+        # Returns time.monotonic() when pl_next.play() has to be called to
+        # start fading in exactly when pl_running starts fading out
+        # or None if pl_running isn't playing:
+        end = pl_running.predicted_end()
+        if end is None:
+            return None
+        return end - pl_running.fadetime_end \
+               - self.get_latency(pl_next.backend)
+
+
+def photo_worker_init():
+    # Photo rendering must not steal CPU time from the video playback loop:
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+class BufferSlice(io.RawIOBase):
+    # Read-only file on data[start:]. Unlike io.BytesIO(data[start:])
+    # it doesn't copy the data:
+    def __init__(self, view, start):
+        self.view = view[start:] # slicing a memoryview doesn't copy
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+def open_raw_preview(filenam):
+    # Returns the largest JPEG preview embedded in a RAW photo:
+    with open(filenam, 'rb') as f:
+        data = f.read()
+    view = memoryview(data)
+    best = None
+    best_pixels = 0
+    pos = data.find(b'\xff\xd8\xff') # JPEG start of image marker
+    while pos >= 0:
+        try:
+            # Only the header is parsed here. A marker found by chance in
+            # front of a preview may parse through to the preview's header.
+            # So the last one of equal size is the real preview:
+            with PIL.Image.open(BufferSlice(view, pos)) as img:
+                if img.format == 'JPEG' and \
+                   img.width * img.height >= best_pixels:
+                    best = pos
+                    best_pixels = img.width * img.height
+        except Exception:
+            pass # the marker bytes are part of the RAW data
+        pos = data.find(b'\xff\xd8\xff', pos + 3)
+    if best is None:
+        raise ValueError('no JPEG preview found')
+    return PIL.Image.open(BufferSlice(view, best))
+
+def render_photo(filenam, cachedir, clip_duration):
+    # Runs in a worker process of the photo ingest.
+    # Returns [ret, filenam, clip]:
+    # ret 0: renditions created or found in the cache
+    #     1: photo file isn't readable
+    #     2: photo file can't be decoded
+    #     3: ffmpeg failed to render the photo clip, the entry is removed
+    #        so the photo is rendered again if it is submitted again
+    digest = hashlib.sha1()
+    try:
+        with open(filenam, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return [1, filenam, None]
+    entry = os.path.join(cachedir, digest.hexdigest())
+    thumb = os.path.join(entry, 'thumb.jpg')
+    display = os.path.join(entry, 'display.jpg')
+    clip = os.path.join(entry, 'photo.mp4')
+    if os.path.isfile(clip):
+        # Cache hit: mark the entry as recently used for the eviction:
+        os.utime(entry)
+        return [0, filenam, clip]
+
+    os.makedirs(entry, exist_ok=True)
+    try:
+        if os.path.splitext(filenam)[1].lower() in PHOTO_EXTENSIONS_RAW:
+            img = open_raw_preview(filenam)
+        else:
+            img = PIL.Image.open(filenam)
+        with img:
+            # Let the JPEG decoder scale down while decoding. This is
+            # much faster than decoding the full resolution of the camera:
+            img.draft('RGB', PHOTO_SIZE_DISPLAY)
+            if img.width * img.height > PHOTO_MAX_PIXELS:
+                raise ValueError('photo too large to be decoded')
+            img = PIL.ImageOps.exif_transpose(img).convert('RGB')
+            img.thumbnail(PHOTO_SIZE_DISPLAY)
+            # The display rendition is letterboxed to the exact screen size
+            # because the video encoder needs even frame dimensions:
+            canvas = PIL.Image.new('RGB', PHOTO_SIZE_DISPLAY)
+            canvas.paste(img, ((PHOTO_SIZE_DISPLAY[0] - img.width) // 2,
+                               (PHOTO_SIZE_DISPLAY[1] - img.height) // 2))
+            canvas.save(display + '.tmp', 'JPEG', quality=90)
+            os.replace(display + '.tmp', display)
+            img.thumbnail(PHOTO_SIZE_THUMB)
+            img.save(thumb + '.tmp', 'JPEG', quality=85)
+            os.replace(thumb + '.tmp', thumb)
+    except Exception:
+        shutil.rmtree(entry, ignore_errors=True)
+        return [2, filenam, None]
+
+    # omxplayer only plays videos. So the display rendition is converted
+    # into a short still clip which is handled like any other video:
+    try:
+        ret = subprocess.call(['ffmpeg', '-nostdin', '-loglevel', 'error',
+                               '-y', '-loop', '1', '-i', display,
+                               '-t', str(clip_duration), '-r', '25',
+                               '-c:v', 'libx264', '-preset', 'ultrafast',
+                               '-pix_fmt', 'yuv420p',
+                               '-f', 'mp4', clip + '.tmp'],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    except OSError:
+        ret = -1 # ffmpeg has been removed since the ingest has been started
+    if ret != 0:
+        # Without the clip the entry is no cache hit. Don't leave its
+        # renditions behind:
+        shutil.rmtree(entry, ignore_errors=True)
+        return [3, filenam, None]
+    os.replace(clip + '.tmp', clip)
+    return [0, filenam, clip]
+
+
+class PhotoIngest:
+    def __init__(self, watchdir, cachedir):
+        self.watchdir = watchdir # directory where the camera stores its photos
+        self.cachedir = cachedir # directory of the rendered photos
+        self.poll_interval = 0.5
+        self.cache_limit = 512 * 1024 * 1024 # bytes
+        self.clip_duration = PHOTO_CLIP_DURATION
+        # Keep one CPU core free for the video playback loop and limit
+        # the memory of photos decoded at once:
+        self.workers = max(1, min(PHOTO_WORKERS_MAX,
+                                  (os.cpu_count() or 1) - 1))
+
+        self.seen = {}    # filename: [size, mtime] of files already submitted
+        self.pending = {} # filename: [[size, mtime], arrival time]
+                          # of files still growing
+        self.jobs = []    # [future, mtime, arrival time] of files
+                          # being rendered
+
+        self.lock = threading.Lock()
+        self.seqno = 0
+        self.latest = None # [seqno, filenam, clip, arrival time]
+                           # of the latest photo
+        self.latest_mtime = 0
+
+        self.pool = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        # Returns 0: ingest is running
+        #         1: Pillow isn't installed
+        #         2: watched directory or cache directory isn't accessible
+        #         3: ffmpeg isn't installed
+        if PIL is None:
+            return 1
+        if shutil.which('ffmpeg') is None:
+            return 3
+        try:
+            os.makedirs(self.watchdir, exist_ok=True)
+            os.makedirs(self.cachedir, exist_ok=True)
+            # Photos which are already there are no new shots:
+            for entry in os.scandir(self.watchdir):
+                self.seen[entry.path] = [entry.stat().st_size,
+                                         entry.stat().st_mtime]
+        except OSError:
+            return 2
+        self.pool = self.new_pool()
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return 0
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.pool is not None:
+            for job in self.jobs:
+                job[0].cancel()
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def new_pool(self):
+        # The workers are started from the ingest thread while other threads
+        # (statistics, profiler, gpiozero) are running. Forking them could
+        # inherit locks held by those threads. Spawned workers start with a
+        # fresh interpreter and their command line doesn't match photomat.py:
+        return concurrent.futures.ProcessPoolExecutor(
+                   max_workers=self.workers,
+                   mp_context=multiprocessing.get_context('spawn'),
+                   initializer=photo_worker_init)
+
+    def submit(self, filenam):
+        try:
+            return self.pool.submit(render_photo, filenam, self.cachedir,
+                                    self.clip_duration)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker has died, e.g. killed by the OOM killer while
+            # decoding a large photo. Replace the pool and try it again:
+            print_verbose('    photo ingest: worker pool broken, restarted ',
+                          VERBOSE_ERROR)
+            self.pool.shutdown(wait=False)
+            self.pool = self.new_pool()
+            return self.pool.submit(render_photo, filenam, self.cachedir,
+                                    self.clip_duration)
+
+    def get_latest(self):
+        # Called by the state machine. It must never wait for the ingest:
+        with self.lock:
+            return self.latest
+
+    def loop(self):
+        while self.running:
+            # Any error must not end the ingest for the rest of the event:
+            try:
+                self.scan()
+                if self.collect():
+                    self.evict()
+            except Exception as e:
+                print_verbose('    photo ingest: {}: {}'.format(
+                              type(e).__name__, e),
+                              VERBOSE_ERROR)
+            time.sleep(self.poll_interval)
+
+    def scan(self):
+        try:
+            entries = list(os.scandir(self.watchdir))
+        except OSError:
+            return
+        for entry in entries:
+            if os.path.splitext(entry.name)[1].lower() not in \
+               PHOTO_EXTENSIONS:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue # file has been removed meanwhile
+            if not entry.is_file():
+                continue
+            state = [stat.st_size, stat.st_mtime]
+            if self.seen.get(entry.path) == state:
+                continue
+            # The camera may still be writing the file. Submit it as soon as
+            # its size and time stamp are stable for one poll interval:
+            pending = self.pending.get(entry.path)
+            if pending is not None and pending[0] == state:
+                del self.pending[entry.path]
+                self.seen[entry.path] = state
+                self.jobs.append([self.submit(entry.path),
+                                  stat.st_mtime, pending[1]])
+                print_verbose('    photo "{}" submitted to the ingest '
+                              .format(entry.path),
+                              VERBOSE_ACTION)
+            elif pending is not None:
+                pending[0] = state
+            else:
+                self.pending[entry.path] = [state, time.time()]
+
+    def collect(self):
+        # Returns True if any renditions have been finished:
+        done = [job for job in self.jobs if job[0].done()]
+        self.jobs = [job for job in self.jobs if not job[0].done()]
+        for future, mtime, arrival in done:
+            try:
+                ret, filenam, clip = future.result()
+            except Exception as e:
+                print_verbose('    photo ingest: worker failed: {}'.format(e),
+                              VERBOSE_ERROR)
+                continue
+            if ret != 0:
+                print_verbose('    photo ingest: "{}" failed (error {})'
+                              .format(filenam, ret),
+                              VERBOSE_ERROR)
+            elif mtime >= self.latest_mtime:
+                # Renditions of a burst may finish in any order.
+                # Only the shot taken last becomes the latest photo:
+                with self.lock:
+                    self.seqno += 1
+                    self.latest = [self.seqno, filenam, clip, arrival]
+                self.latest_mtime = mtime
+                print_verbose('    photo "{}" is ready to be shown '
+                              .format(filenam),
+                              VERBOSE_VIDEOINFO)
+        return len(done) > 0
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits its limit:
+        keep = None
+        with self.lock:
+            if self.latest is not None:
+                keep = os.path.dirname(self.latest[PHOTO_CLIP])
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cachedir):
+            # The workers replace and remove files in the cache meanwhile:
+            try:
+                # Only the entries named by the SHA-1 of a photo belong to
+                # the photo cache:
+                if len(entry.name) != 40 or \
+                   entry.name.strip('0123456789abcdef') != '' or \
+                   not entry.is_dir():
+                    continue
+                size = 0
+                for f in os.scandir(entry.path):
+                    try:
+                        size += f.stat().st_size
+                    except OSError:
+                        pass
+                entries.append([entry.stat().st_mtime, entry.path, size])
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.cache_limit:
+                break
+            # Entries younger than a minute may still be rendered:
+            if path != keep and mtime < time.time() - 60:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+class VC_RECT_T(ctypes.Structure):
+    _fields_ = [('x', ctypes.c_int32), ('y', ctypes.c_int32),
+                ('width', ctypes.c_int32), ('height', ctypes.c_int32)]
+
+class VC_DISPMANX_ALPHA_T(ctypes.Structure):
+    _fields_ = [('flags', ctypes.c_int), ('opacity', ctypes.c_uint32),
+                ('mask', ctypes.c_uint32)]
+
+def load_bcm_host():
+    # Returns the Raspberry Pi's libbcm_host which drives the dispmanx
+    # layers or None if it isn't available:
+    for name in [ctypes.util.find_library('bcm_host'),
+                 'libbcm_host.so.0', '/opt/vc/lib/libbcm_host.so']:
+        if name is None:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        u32 = ctypes.c_uint32
+        rect = ctypes.POINTER(VC_RECT_T)
+        lib.bcm_host_init.argtypes = []
+        lib.bcm_host_init.restype = None
+        lib.vc_dispmanx_display_open.argtypes = [u32]
+        lib.vc_dispmanx_display_open.restype = u32
+        lib.vc_dispmanx_display_close.argtypes = [u32]
+        lib.vc_dispmanx_resource_create.argtypes = [ctypes.c_int, u32, u32,
+                                                    ctypes.POINTER(u32)]
+        lib.vc_dispmanx_resource_create.restype = u32
+        lib.vc_dispmanx_resource_write_data.argtypes = [u32, ctypes.c_int,
+                                                        ctypes.c_int,
+                                                        ctypes.c_char_p, rect]
+        lib.vc_dispmanx_resource_delete.argtypes = [u32]
+        lib.vc_dispmanx_update_start.argtypes = [ctypes.c_int32]
+        lib.vc_dispmanx_update_start.restype = u32
+        lib.vc_dispmanx_update_submit.argtypes = [u32, ctypes.c_void_p,
+                                                  ctypes.c_void_p]
+        lib.vc_dispmanx_element_add.argtypes = [
+            u32, u32, ctypes.c_int32, rect, u32, rect, u32,
+            ctypes.POINTER(VC_DISPMANX_ALPHA_T), ctypes.c_void_p,
+            ctypes.c_int]
+        lib.vc_dispmanx_element_add.restype = u32
+        lib.vc_dispmanx_element_change_attributes.argtypes = [
+            u32, u32, u32, ctypes.c_int32, ctypes.c_uint8, rect, rect, u32,
+            ctypes.c_int]
+        lib.vc_dispmanx_element_remove.argtypes = [u32, u32]
+        lib.bcm_host_init()
+        return lib
+    return None
+
+
+class OverlayLayer:
+    def __init__(self, layer, cachedir):
+        self.layer = layer # dispmanx layer above the countdown video
+        self.cachedir = cachedir # directory of the pre-rendered overlays
+        self.bcm_host = None
+        self.display = 0 # dispmanx display handle
+        self.overlays = [] # [overlay, resource, width, height] of the
+                           # overlays uploaded into the GPU memory
+        self.elements = [] # dispmanx elements of self.overlays while the
+                           # countdown video is loaded
+        self.shown = set() # indices of the visible elements
+
+    def prepare(self, overlays):
+        # Renders the overlays once per configuration and uploads them into
+        # the GPU memory. Must be called before the buzzer is pressed.
+        # Returns the number of failed overlays.
+        self.close()
+        if not overlays:
+            return 0
+        self.bcm_host = load_bcm_host()
+        if self.bcm_host is not None:
+            self.display = self.bcm_host.vc_dispmanx_display_open(
+                                OVERLAY_DISPLAY)
+        if self.display == 0:
+            print_verbose('overlays disabled: dispmanx isn\'t available',
+                          VERBOSE_ERROR)
+            self.bcm_host = None
+            return len(overlays)
+        failed = 0
+        for overlay in overlays:
+            pngfile = self.render(overlay)
+            resource = self.upload(pngfile) if pngfile is not None else None
+            if resource is None:
+                failed += 1
+                print_verbose('    overlay "{}" can\'t be rendered'.format(
+                              overlay[OVL_TEXT] or overlay[OVL_IMAGE]),
+                              VERBOSE_ERROR)
+            else:
+                self.overlays.append([overlay] + resource)
+        return failed
+
+    def upload(self, pngfile):
+        # Returns [resource, width, height] of the overlay uploaded into
+        # the GPU memory or None on errors:
+        with PIL.Image.open(pngfile) as img:
+            img = img.convert('RGBA')
+        # dispmanx expects the rows aligned to 16 pixels:
+        pitch = (img.width + 15) // 16 * 16 * 4
+        padded = PIL.Image.new('RGBA', (pitch // 4, img.height))
+        padded.paste(img, (0, 0))
+        native_image = ctypes.c_uint32()
+        resource = self.bcm_host.vc_dispmanx_resource_create(
+                       VC_IMAGE_RGBA32, img.width, img.height,
+                       ctypes.byref(native_image))
+        if resource == 0:
+            return None
+        rect = VC_RECT_T(0, 0, img.width, img.height)
+        self.bcm_host.vc_dispmanx_resource_write_data(
+            resource, VC_IMAGE_RGBA32, pitch, padded.tobytes(),
+            ctypes.byref(rect))
+        return [resource, img.width, img.height]
+
+    def render(self, overlay):
+        # Returns the file name of the rendered overlay or None on errors
+        if PIL is None:
+            return None
+        key = [overlay[OVL_TEXT], overlay[OVL_IMAGE], overlay[OVL_FONT],
+               overlay[OVL_SIZE], overlay[OVL_GEOMETRY]]
+        try:
+            if overlay[OVL_IMAGE] is not None:
+                # A changed image file must be rendered again:
+                key.append(os.stat(overlay[OVL_IMAGE]).st_mtime)
+            pngfile = os.path.join(self.cachedir, hashlib.sha1(
+                                   repr(key).encode()).hexdigest() + '.png')
+            if os.path.isfile(pngfile):
+                return pngfile
+
+            x1, y1, x2, y2 = [int(v) for v in
+                              overlay[OVL_GEOMETRY].split(',')]
+            canvas = PIL.Image.new('RGBA', (x2 - x1 + 1, y2 - y1 + 1))
+            if overlay[OVL_IMAGE] is not None:
+                with PIL.Image.open(overlay[OVL_IMAGE]) as img:
+                    img = img.convert('RGBA')
+                    img.thumbnail(canvas.size)
+                    canvas.alpha_composite(img,
+                        ((canvas.width - img.width) // 2,
+                         (canvas.height - img.height) // 2))
+            if overlay[OVL_TEXT]:
+                font = PIL.ImageFont.truetype(overlay[OVL_FONT],
+                                              overlay[OVL_SIZE])
+                draw = PIL.ImageDraw.Draw(canvas)
+                # A dark outline keeps the text readable on any video:
+                stroke = max(1, overlay[OVL_SIZE] // 20)
+                bbox = draw.textbbox((0, 0), overlay[OVL_TEXT], font=font,
+                                     stroke_width=stroke)
+                draw.text(((canvas.width - bbox[2] - bbox[0]) // 2,
+                           (canvas.height - bbox[3] - bbox[1]) // 2),
+                          overlay[OVL_TEXT], font=font,
+                          fill=(255, 255, 255, 255), stroke_width=stroke,
+                          stroke_fill=(0, 0, 0, 255))
+            os.makedirs(self.cachedir, exist_ok=True)
+            canvas.save(pngfile + '.tmp', 'PNG')
+            os.replace(pngfile + '.tmp', pngfile)
+        except Exception:
+            return None
+        return pngfile
+
+    def attach(self):
+        # Adds the overlays invisible (opacity 0) above the countdown video.
+        # Called when the countdown video is loaded. So showing them later
+        # costs only an opacity change:
+        if self.bcm_host is None or self.elements or not self.overlays:
+            return
+        update = self.bcm_host.vc_dispmanx_update_start(0)
+        for overlay, resource, width, height in self.overlays:
+            x1, y1 = [int(v) for v in overlay[OVL_GEOMETRY].split(',')[0:2]]
+            dest = VC_RECT_T(x1, y1, width, height)
+            src = VC_RECT_T(0, 0, width << 16, height << 16) # 16.16 fixed
+            alpha = VC_DISPMANX_ALPHA_T(DISPMANX_FLAGS_ALPHA_FROM_SOURCE
+                                        | DISPMANX_FLAGS_ALPHA_MIX, 0, 0)
+            self.elements.append(self.bcm_host.vc_dispmanx_element_add(
+                update, self.display, self.layer, ctypes.byref(dest),
+                resource, ctypes.byref(src), DISPMANX_PROTECTION_NONE,
+                ctypes.byref(alpha), None, DISPMANX_NO_ROTATE))
+        self.bcm_host.vc_dispmanx_update_submit(update, None, None)
+
+    def detach(self):
+        # Removes the overlays after the countdown video has been unloaded:
+        if self.elements:
+            update = self.bcm_host.vc_dispmanx_update_start(0)
+            for element in self.elements:
+                self.bcm_host.vc_dispmanx_element_remove(update, element)
+            self.bcm_host.vc_dispmanx_update_submit(update, None, None)
+        self.elements = []
+        self.shown = set()
+
+    def close(self):
+        self.detach()
+        if self.bcm_host is not None:
+            for overlay in self.overlays:
+                self.bcm_host.vc_dispmanx_resource_delete(overlay[1])
+            self.bcm_host.vc_dispmanx_display_close(self.display)
+        self.bcm_host = None
+        self.display = 0
+        self.overlays = []
+
+    def update(self, pl):
+        # Shows the overlays which are due at the playback position of the
+        # countdown video pl and hides the others:
+        if not self.elements:
+            return
+        shown = set()
+        if pl.omxplayer is not None and pl.playback_status == 'Playing':
+            # pl.position is only polled once per pass of the state machine.
+            # The position predicted from the start time is current when
+            # the overlays are switched:
+            position = pl.predicted_position(time.monotonic())
+            for index, overlay in enumerate(self.overlays):
+                # Negative times are counted from the end of the video:
+                start = overlay[0][OVL_START] if overlay[0][OVL_START] >= 0 \
+                        else pl.duration + overlay[0][OVL_START]
+                end = overlay[0][OVL_END] if overlay[0][OVL_END] >= 0 \
+                      else pl.duration + overlay[0][OVL_END]
+                if start <= position < end:
+                    shown.add(index)
+        if shown == self.shown:
+            return
+        # All changes are submitted at once without waiting for vsync:
+        update = self.bcm_host.vc_dispmanx_update_start(0)
+        for index in shown ^ self.shown:
+            self.bcm_host.vc_dispmanx_element_change_attributes(
+                update, self.elements[index],
+                DISPMANX_ELEMENT_CHANGE_OPACITY, self.layer,
+                255 if index in shown else 0, None, None, 0,
+                DISPMANX_NO_ROTATE)
+            print_verbose('    overlay[{}] {} '.format(
+                          index, 'shown' if index in shown else 'hidden'),
+                          VERBOSE_ACTION)
+        self.bcm_host.vc_dispmanx_update_submit(update, None, None)
+        self.shown = shown
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id, dumpdir):
+        self.thread_id = thread_id # thread to be sampled (main thread)
+        self.dumpdir = dumpdir # directory of the collapsed stack files
+        self.interval = PROFILE_INTERVAL
+
+        self.labels = {} # code object: function name shown in the stacks
+        self.stacks = {} # collapsed stack: number of samples
+        self.attributed = {} # profiled function: number of samples
+        self.samples = 0
+        self.started = 0
+        self.dumps = 0 # number of the dump: a SIGUSR2 dump and the final
+                       # dump may be written within the same second
+
+        # The signal handlers only set these flags. Everything else is
+        # done by the sampling thread, so the handlers never block the
+        # playback loop nor write to stdout:
+        self.running = False
+        self.toggle_requests = 0 # incremented by the signal handler only
+        self.toggles_done = 0 # incremented by the sampling thread only
+        self.dump_requested = False
+        self.exiting = False
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Writes the collapsed stacks if the profiler is still running:
+        self.exiting = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def request_toggle(self):
+        self.toggle_requests += 1
+
+    def request_dump(self):
+        self.dump_requested = True
+
+    def loop(self):
+        while not self.exiting:
+            while self.toggles_done < self.toggle_requests:
+                self.toggles_done += 1
+                if self.running:
+                    self.running = False
+                    self.dump()
+                    print_verbose('    profiler stopped ', VERBOSE_ACTION)
+                else:
+                    self.stacks = {}
+                    self.attributed = {}
+                    self.samples = 0
+                    self.started = time.monotonic()
+                    self.running = True
+                    print_verbose('    profiler started (every {}s) '.format(
+                                  self.interval),
+                                  VERBOSE_ACTION)
+            if self.running:
+                self.sample()
+            if self.dump_requested:
+                self.dump_requested = False
+                if self.running:
+                    self.dump()
+            # Poll the flags less often while the profiler is off:
+            time.sleep(self.interval if self.running else PROFILE_IDLE_POLL)
+        if self.running:
+            self.running = False
+            self.dump()
+
+    def label(self, frame):
+        code = frame.f_code
+        name = self.labels.get(code)
+        if name is None:
+            name = getattr(code, 'co_qualname', None) # Python >= 3.11
+            if name is None:
+                name = code.co_name
+                if code.co_varnames[:1] == ('self',) and \
+                   'self' in frame.f_locals:
+                       name = '{}.{}'.format(
+                              type(frame.f_locals['self']).__name__, name)
+            self.labels[code] = name
+        return name
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame))
+            frame = frame.f_back
+        if not stack:
+            return
+        stack.reverse()
+        collapsed = ';'.join(stack)
+        self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+        self.samples += 1
+        # Attribute the sample to every profiled function on the stack:
+        for name in set(stack):
+            if name in PROFILE_TARGETS or \
+               name.startswith('StateMachine.state_'):
+                self.attributed[name] = self.attributed.get(name, 0) + 1
+
+    def dump(self):
+        self.dumps += 1
+        filenam = os.path.join(self.dumpdir,
+                               'photomat-{}-{}-{}.folded'.format(
+                               os.getpid(), time.strftime('%Y%m%d-%H%M%S'),
+                               self.dumps))
+        try:
+            with open(filenam, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+        except OSError as e:
+            print_verbose('    profiler: cannot write "{}": {}'.format(
+                          filenam, e),
+                          VERBOSE_ERROR)
+            return
+        print_verbose('    profiler: {} samples written to "{}" '.format(
+                      self.samples, filenam),
+                      VERBOSE_ACTION)
+        # The sampling thread competes with the main thread for the GIL.
+        # So the time is derived from the share of samples, not from the
+        # sampling interval:
+        elapsed = time.monotonic() - self.started
+        for name, count in sorted(self.attributed.items(),
+                                  key=lambda item: -item[1]):
+            print_verbose('      {:6.1f}% {:8.3f}s {}'.format(
+                          100 * count / self.samples,
+                          elapsed * count / self.samples,
+                          name),
+                          VERBOSE_ACTION)
+
+
 class StateMachine:
     def __init__(self):
         self.cmdlin_params = sys.argv[1:]
@@ -312,10 +1173,75 @@ class StateMachine:
         # Non-video properties:
         self.timeslot = 0.02 # todo: CMDLIN_PARAM
         
+        # Crossfades are scheduled to predicted times instead of timeslots:
+        self.planner = TransitionPlanner()
+        self.play_at = None # time.monotonic() of the next scheduled play()
+        
         self.randomindex_idle = 0  # -1 random selection 0 continuous selection
         self.randomindex_cntdn = 0 # -1 random selection 0 continuous selection
         self.randomindex_appl = 0  # -1 random selection 0 continuous selection
         
+        # Overlays above the countdown video:
+        # They are rendered once into self.overlay_cache, uploaded into the
+        # GPU memory at start and replace numerals and logos burned into
+        # the countdown videos.
+        self.overlays_cntdn = []
+        #self.overlays_cntdn = [
+        #    [-5, -4, '3', None, OVERLAY_FONT, 400, '780,70,1740,610'],
+        #    [-4, -3, '2', None, OVERLAY_FONT, 400, '780,70,1740,610'],
+        #    [-3, -2, '1', None, OVERLAY_FONT, 400, '780,70,1740,610'],
+        #    [-2, -1, 'smile!', None, OVERLAY_FONT, 200, '780,70,1740,610'],
+        #    [0, -1, '', '/home/pi/Pictures/logo.png', OVERLAY_FONT, 0,
+        #     '1540,470,1740,610'],
+        #   ]
+        self.overlay_cache = '/home/pi/.cache/photomat-overlays'
+        self.overlay = OverlayLayer(OMXLAYER_OVERLAY, self.overlay_cache)
+        self.overlay.prepare(self.overlays_cntdn)
+
+        # Photo ingest:
+        # The camera triggered by self.gpio_triggerpin stores its photos in
+        # self.photo_dir. The latest photo is shown like an applause video.
+        self.photo_dir = '/home/pi/Pictures/photomat' # todo: CMDLIN_PARAM
+        self.photo_cache = '/home/pi/.cache/photomat' # todo: CMDLIN_PARAM
+        self.photo_mode = PHOTO_AFTER_APPL # todo: CMDLIN_PARAM
+        self.photo_shown = 0 # sequence number of the last photo shown
+        self.session_time = 0 # time.time() when the buzzer has been pressed
+        self.photo_waiting = False # True until the shot of the session
+                                   # has been selected
+        self.photo_deadline = 0 # time.monotonic() until the applause video
+                                # waits for the shot (PHOTO_REPLACE_APPL)
+        self.ingest = PhotoIngest(self.photo_dir, self.photo_cache)
+        if self.photo_mode != PHOTO_NONE:
+            ret = self.ingest.start()
+            if ret == 1:
+                print_verbose('photo ingest disabled: Pillow isn\'t installed',
+                              VERBOSE_ERROR)
+            elif ret == 2:
+                print_verbose('photo ingest disabled: "{}" isn\'t accessible'
+                              .format(self.photo_dir),
+                              VERBOSE_ERROR)
+            elif ret == 3:
+                print_verbose('photo ingest disabled: ffmpeg isn\'t installed',
+                              VERBOSE_ERROR)
+        
+        # Sampling profiler:
+        # SIGUSR1 switches it on and off. SIGUSR2 writes the collapsed
+        # stacks sampled so far. They are written also when switched off.
+        self.profiler = SamplingProfiler(threading.main_thread().ident,
+                                         PROFILE_DUMPDIR)
+        self.profiler.start_thread()
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
+        signal.signal(signal.SIGUSR2, self.on_sigusr2)
+
+        # Statistics: the events are written in batches by a background
+        # thread to avoid writes to the SD card on the hot path:
+        self.stats = photomat_stats.StatsStore(
+                         photomat_stats.STATS_DBFILE) # todo: CMDLIN_PARAM
+        if self.stats.open() != 0:
+            print_verbose('statistics disabled: "{}" can\'t be opened'.format(
+                          self.stats.filenam),
+                          VERBOSE_ERROR)
+
         # Initialisation of the state machine:
         self.errmsg = ''
         self.state = STATE_SELECT_IDLE_VIDEO
@@ -355,6 +1281,12 @@ class StateMachine:
             name = '<unknown state>'
         return name
 
+    def on_sigusr1(self, signum, frame):
+        self.profiler.request_toggle()
+
+    def on_sigusr2(self, signum, frame):
+        self.profiler.request_dump()
+
     def random_video(self, instance, applause):
         if instance == OMXINSTANCE_IDLE1 or \
            instance == OMXINSTANCE_IDLE2:
@@ -396,6 +1328,36 @@ class StateMachine:
                 filenam = None
         return [index, filenam]
 
+    def photo_video(self, applause):
+        # Returns the clip of the latest photo if it should be shown now
+        # instead of a randomly selected video. Photos which have appeared
+        # before the buzzer was pressed belong to the previous guest:
+        photo = self.ingest.get_latest()
+        if photo is not None and \
+           photo[PHOTO_SEQNO] > self.photo_shown and \
+           photo[PHOTO_ARRIVAL] >= self.session_time and \
+           ((self.photo_mode == PHOTO_REPLACE_APPL and applause) or \
+            (self.photo_mode == PHOTO_AFTER_APPL and not applause)):
+                self.photo_shown = photo[PHOTO_SEQNO]
+                self.photo_waiting = False
+                return [photo[PHOTO_SEQNO], photo[PHOTO_CLIP]]
+        return [-1, None]
+
+    def photo_pending(self, applause):
+        # The camera is triggered near the end of the countdown video.
+        # Returns True while the selection of the applause video
+        # (PHOTO_REPLACE_APPL) resp. of the first idle video after it
+        # (PHOTO_AFTER_APPL) shall wait for this shot:
+        if not self.photo_waiting or \
+           not self.ingest.running or \
+           time.monotonic() >= self.photo_deadline:
+            return False
+        if not ((self.photo_mode == PHOTO_REPLACE_APPL and applause) or \
+                (self.photo_mode == PHOTO_AFTER_APPL and not applause)):
+            return False
+        photo = self.ingest.get_latest()
+        return photo is None or photo[PHOTO_ARRIVAL] < self.session_time
+
     def get_idle_instance_waiting(self):
         if self.pl[OMXINSTANCE_IDLE1].playback_status == 'None' or \
            self.pl[OMXINSTANCE_IDLE1].playback_status == 'Stopped' or \
@@ -411,16 +1373,29 @@ class StateMachine:
         return inst
 
     def select_video(self, fadetime):
+        applause = self.state == STATE_SELECT_APPL_VIDEO
         inst = self.get_idle_instance_waiting()
         if inst == OMXINSTANCE_NONE:
             # Do nothing if there is no free idle-instance.
             # Even don't touch the state of the state machine.
             pass
+        elif self.photo_pending(applause):
+            # Wait for the shot which replaces resp. follows the applause
+            # video.
+            # Even don't touch the state of the state machine.
+            inst = OMXINSTANCE_NONE
         else:
-            # Initialise a new omxplayer instance with a random video file:
-            video = self.random_video(inst,
-                                      self.state == STATE_SELECT_APPL_VIDEO)
+            # Initialise a new omxplayer instance with the latest photo
+            # or with a random video file:
+            video = self.photo_video(applause)
+            if video[VID_INDEX] >= 0:
+                role = photomat_stats.ROLE_PHOTO
+            else:
+                video = self.random_video(inst, applause)
+                role = photomat_stats.ROLE_APPL if applause \
+                       else photomat_stats.ROLE_IDLE
             if video[VID_INDEX] >= 0:
+                self.pl[inst].role = role
                 self.pl[inst].fadetime_start = fadetime
                 self.pl[inst].fadetime_end = fadetime
                 self.pl[inst].alpha_start = 0
@@ -434,7 +1409,7 @@ class StateMachine:
                 #print_verbose('#Error-Gaudi: wait for 0.25sec', VERBOSE_ERROR)
                 #time.sleep(0.25) # Error-Gaudi
                 
-                self.pl[inst].load_omxplayer(
+                ret = self.pl[inst].load_omxplayer(
                     video[VID_FILENAM],
                     ['--win', self.pl[inst].fullscreen,
                      '--aspect-mode', 'letterbox',
@@ -444,6 +1419,8 @@ class StateMachine:
                     ] + self.cmdlin_params,
                     dbus_name=dbus_path,
                     pause=True)
+                self.stats.record(photomat_stats.EVENT_LOAD, role,
+                                  video[VID_FILENAM], ret)
 
                 ## Error-Gaudi:
                 #print_verbose('#Error-Gaudi: wait for 0.05sec', VERBOSE_ERROR)
@@ -467,6 +1444,10 @@ class StateMachine:
 
     def manage_players(self):
         self.pl[self.manage_instance].updt_playback_status()
+        if self.pl[self.manage_instance].latency_sample is not None:
+            self.planner.learn(self.pl[self.manage_instance].backend,
+                               self.pl[self.manage_instance].latency_sample)
+            self.pl[self.manage_instance].latency_sample = None
         # Delete finished omxplayer instance: 
         if self.pl[self.manage_instance].playback_status == 'Stopped' or \
            self.pl[self.manage_instance].playback_status[0:9] == 'Exception':
@@ -476,8 +1457,11 @@ class StateMachine:
             # finished and unloaded:
             if self.manage_instance == OMXINSTANCE_CNTDN:
                 self.buzzer_enabled = True
+                self.overlay.detach()
         # video fading:
         self.pl[self.manage_instance].fade()
+        if self.manage_instance == OMXINSTANCE_CNTDN:
+            self.overlay.update(self.pl[OMXINSTANCE_CNTDN])
 
         self.manage_instance += 1
         if self.manage_instance >= len(self.pl):
@@ -524,12 +1508,15 @@ class StateMachine:
         # is the waiting video ...?
         if self.pl[inst_waiting].playback_status == 'None':
             pass
-        # is the current video fading out yet?
-        if (self.pl[inst_running].duration \
-            - self.pl[inst_running].position \
-            <= self.pl[inst_running].fadetime_end \
-               + 3 * self.timeslot) \
-           or \
+        # will the current video start fading out within the next timeslot?
+        play_time = self.planner.play_time(self.pl[inst_running],
+                                           self.pl[inst_waiting])
+        if play_time is not None and \
+           play_time - time.monotonic() <= self.timeslot:
+            # wake up the state machine exactly at play_time. A missed
+            # schedule (e.g. a short video) must not be learned as latency:
+            self.play_at = max(play_time, time.monotonic())
+        if self.play_at is not None or \
            (self.pl[inst_running].playback_status
             in ['None', 'Stopped']): # in-command checks "no video is running"
                     if inst_waiting == OMXINSTANCE_IDLE1:
@@ -551,9 +1538,10 @@ class StateMachine:
             # On isNone-error set state machine to select a new video:
             self.state = STATE_SELECT_IDLE_VIDEO
         else:    
-            self.pl[inst].omxplayer.set_position(0)
-            self.pl[inst].set_alpha(self.pl[inst].alpha_start)
-            self.pl[inst].omxplayer.play()
+            self.pl[inst].play(self.play_at)
+            self.play_at = None
+            self.stats.record(photomat_stats.EVENT_PLAY, self.pl[inst].role,
+                              self.pl[inst].filenam)
             # Important -- This command was moved:
             #self.buzzer_enabled = True # moved to method self.manage_players()
             self.state = STATE_SELECT_IDLE_VIDEO
@@ -578,10 +1566,11 @@ class StateMachine:
                 self.pl[OMXINSTANCE_CNTDN].gpio_off = 1 # todo: METAFILE
 
                 self.pl[OMXINSTANCE_CNTDN].last_alpha = 0
+                self.pl[OMXINSTANCE_CNTDN].role = photomat_stats.ROLE_CNTDN
 
                 dbus_path = 'org.mpris.MediaPlayer2.omxplayer{}_{}'\
                             .format(os.getpid(), OMXINSTANCE_CNTDN)
-                self.pl[OMXINSTANCE_CNTDN].load_omxplayer(
+                ret = self.pl[OMXINSTANCE_CNTDN].load_omxplayer(
                     video[VID_FILENAM],
                     ['--win', self.pl[OMXINSTANCE_CNTDN].fullscreen,
                      '--aspect-mode', 'letterbox',
@@ -591,6 +1580,16 @@ class StateMachine:
                     ] + self.cmdlin_params,
                     dbus_name=dbus_path,
                     pause=True)
+                self.stats.record(photomat_stats.EVENT_LOAD,
+                                  photomat_stats.ROLE_CNTDN,
+                                  video[VID_FILENAM], ret)
+                # Don't wait longer for the shot than the countdown video
+                # plus the time the camera needs to store it:
+                self.photo_deadline = time.monotonic() + PHOTO_WAIT_TIMEOUT \
+                    + max(0, self.pl[OMXINSTANCE_CNTDN].duration)
+                # Create the overlays invisible before the countdown starts:
+                if self.pl[OMXINSTANCE_CNTDN].omxplayer is not None:
+                    self.overlay.attach()
                 print_verbose(
                     '    instance[{}] initialised with video[{}] "{}" '.format(
                     OMXINSTANCE_CNTDN, video[VID_INDEX], video[VID_FILENAM]),
@@ -603,6 +1602,12 @@ class StateMachine:
             self.state = STATE_START_CNTDN_VIDEO
 
     def state_start_cntdn_video(self):
+        # The countdown video is started in the next timeslot. It fades in
+        # as soon as its play latency has elapsed:
+        now = time.monotonic()
+        self.play_at = now + self.timeslot
+        cntdn_start = self.play_at + self.planner.get_latency(
+                                     self.pl[OMXINSTANCE_CNTDN].backend)
         for pl in self.pl[OMXINSTANCE_IDLE1:OMXINSTANCE_IDLE2 + 1]:
             if pl.playback_status == 'Playing' or \
                pl.playback_status == 'Paused':
@@ -613,8 +1618,9 @@ class StateMachine:
                 # sequence:
                 pl.fadetime_end = self.pl[OMXINSTANCE_CNTDN].fadetime_end
                 # shorten the duration of the running idle video sequence
-                # to "now" + fade_out time of countdown video sequence:
-                pl.duration = pl.position + pl.fadetime_end + self.timeslot
+                # to start its fade-out when the countdown video starts:
+                pl.duration = pl.predicted_position(now) \
+                              + (cntdn_start - now) + pl.fadetime_end
         self.state = STATE_PLAY_CNTDN_VIDEO
 
     def state_play_cntdn_video(self):
@@ -631,10 +1637,11 @@ class StateMachine:
             #              self.state_name()),
             #              VERBOSE_ERROR) # Error-Gaudi
         else:
-            self.pl[OMXINSTANCE_CNTDN].omxplayer.set_position(0)
-            self.pl[OMXINSTANCE_CNTDN].set_alpha(
-                 self.pl[OMXINSTANCE_CNTDN].alpha_start)
-            self.pl[OMXINSTANCE_CNTDN].omxplayer.play()
+            self.pl[OMXINSTANCE_CNTDN].play(self.play_at)
+            self.play_at = None
+            self.stats.record(photomat_stats.EVENT_PLAY,
+                              photomat_stats.ROLE_CNTDN,
+                              self.pl[OMXINSTANCE_CNTDN].filenam)
             self.state = STATE_WAIT1_CNTDN_VIDEO
 
     def state_wait_cntdn_video(self):
@@ -651,12 +1658,17 @@ class StateMachine:
                    # Load the first idle instance with applause video:
                    self.state = STATE_SELECT_APPL_VIDEO
                 
-            # DEBUG! -- check if necessary any longer!!!
-            remaining = self.pl[OMXINSTANCE_CNTDN].duration \
-                        - self.pl[OMXINSTANCE_CNTDN].position
-            if remaining <= self.pl[OMXINSTANCE_CNTDN].fadetime_end:
-                # change state of state machine:
-                self.state = STATE_START_IDLE1_VIDEO
+            # Start the applause video when the countdown video starts
+            # fading out:
+            play_time = self.planner.play_time(self.pl[OMXINSTANCE_CNTDN],
+                                               self.pl[OMXINSTANCE_IDLE1])
+            if play_time is not None and \
+               play_time - time.monotonic() <= self.timeslot:
+                # change state of state machine. The other idle instance
+                # isn't running, so play directly like the idle videos do
+                # to get the same play latency:
+                self.play_at = max(play_time, time.monotonic())
+                self.state = STATE_PLAY_IDLE1_VIDEO
         else: # self.pl[OMXINSTANCE_CNTDN] isn't running
                 self.state = STATE_START_IDLE1_VIDEO
 
@@ -671,11 +1683,18 @@ class StateMachine:
         exitbtn_debounce = 0
         
         while self.state:
-            time.sleep(self.timeslot)
+            if self.play_at is None:
+                time.sleep(self.timeslot)
+            else:
+                # Wake up exactly when a scheduled play() is due:
+                time.sleep(max(0, min(self.timeslot,
+                                      self.play_at - time.monotonic())))
             self.manage_players()
 
             # Print current state of the state machine:
             if self.state != last_state:
+                self.stats.record(photomat_stats.EVENT_STATE,
+                                  self.state_name())
                 print_verbose('STATE=={}: "{}" '.format(self.state,
                                                         self.state_name()),
                               VERBOSE_STATE)
@@ -699,6 +1718,9 @@ class StateMachine:
                                   ' (debounced) ',
                                   VERBOSE_GPIO)
                     self.buzzer_enabled = False
+                    self.session_time = time.time()
+                    self.photo_waiting = self.photo_mode != PHOTO_NONE
+                    self.stats.record(photomat_stats.EVENT_SESSION)
                     self.state = STATE_SELECT_CNTDN_VIDEO
             
             # Check for exit button:
@@ -739,9 +1761,23 @@ class StateMachine:
             elif self.state == STATE_WAIT1_CNTDN_VIDEO or \
                  self.state == STATE_WAIT2_CNTDN_VIDEO:
                 self.state_wait_cntdn_video()
+
+            # Drop a scheduled play() if the state machine has been
+            # diverted meanwhile (e.g. by the buzzer):
+            if self.play_at is not None and \
+               self.state not in [STATE_START_IDLE1_VIDEO,
+                                  STATE_START_IDLE2_VIDEO,
+                                  STATE_PLAY_IDLE1_VIDEO,
+                                  STATE_PLAY_IDLE2_VIDEO,
+                                  STATE_PLAY_CNTDN_VIDEO]:
+                self.play_at = None
         # cleanup all omxplayer instances
         for pl in self.pl:
             pl.unload_omxplayer()
+        self.overlay.close()
+        self.ingest.stop()
+        self.stats.close()
+        self.profiler.close()
         if VERBOSITY >= VERBOSE_STATE:
             print()
 
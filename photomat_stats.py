@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+# photomat_stats.py
+# Copyright (C) 2020-2021 schlizbäda
+#
+# photomat_stats.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photomat_stats.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photomat_stats.py. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Statistics of photomat.py:
+# --------------------------
+# photomat.py records its sessions, state transitions and video loads in an
+# SQLite database. Started as a script, this module prints per-day and
+# per-clip summaries of that database:
+#
+#   python3 photomat_stats.py [--db <file>] [days|clips]
+#
+
+import time
+import os         # makedirs()
+import sys        # exitcode
+import threading  # background thread writing the events
+import sqlite3
+import argparse
+import datetime
+
+
+STATS_DBFILE = '/home/pi/.local/share/photomat/stats.db'
+STATS_FLUSH_INTERVAL = 5.0 # seconds between two writes to the SD card
+
+# Kinds of events:
+EVENT_STATE = 'state'     # name: state of the state machine
+EVENT_SESSION = 'session' # buzzer has been pressed
+EVENT_LOAD = 'load'       # name: role, clip: video file,
+                          # code: return code of load_omxplayer()
+EVENT_PLAY = 'play'       # name: role, clip: video file
+
+# Roles of the videos:
+ROLE_IDLE = 'idle'
+ROLE_CNTDN = 'cntdn'
+ROLE_APPL = 'appl'
+ROLE_PHOTO = 'photo'
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS events (
+                ts REAL NOT NULL,
+                kind TEXT NOT NULL,
+                name TEXT,
+                clip TEXT,
+                code INTEGER)'''
+
+
+def connect(filenam):
+    conn = sqlite3.connect(filenam)
+    # WAL mode: Readers like the summary CLI don't block the writer and
+    # each batch costs only a sequential append to the WAL file:
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(SCHEMA)
+    conn.execute('CREATE INDEX IF NOT EXISTS events_ts ON events (ts)')
+    conn.commit()
+    return conn
+
+
+class StatsStore:
+    def __init__(self, filenam=STATS_DBFILE):
+        self.filenam = filenam
+        self.flush_interval = STATS_FLUSH_INTERVAL
+
+        self.buffer = [] # events not yet written to the database
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        self.thread = None
+        self.running = False
+
+    def open(self):
+        # Returns 0: the events are recorded
+        #         1: the database can't be opened
+        try:
+            os.makedirs(os.path.dirname(self.filenam) or '.', exist_ok=True)
+            connect(self.filenam).close()
+        except (OSError, sqlite3.Error):
+            return 1
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return 0
+
+    def close(self):
+        # Writes the remaining events before it returns:
+        if self.thread is not None:
+            self.running = False
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+
+    def record(self, kind, name=None, clip=None, code=None):
+        # Called on the hot path of the state machine.
+        # It never touches the database:
+        if self.running:
+            with self.lock:
+                self.buffer.append((time.time(), kind, name, clip, code))
+
+    def loop(self):
+        # The sqlite connection must be used by the thread created it:
+        try:
+            conn = connect(self.filenam)
+        except (OSError, sqlite3.Error) as e:
+            # Stop recording, otherwise the buffer would grow without limit:
+            self.running = False
+            with self.lock:
+                events, self.buffer = self.buffer, []
+            print('ERROR: statistics disabled, {} events lost: {}'.format(
+                  len(events), e))
+            return
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.flush(conn)
+        self.flush(conn)
+        conn.close()
+
+    def flush(self, conn):
+        with self.lock:
+            events, self.buffer = self.buffer, []
+        if events:
+            try:
+                with conn:
+                    conn.executemany('INSERT INTO events VALUES (?,?,?,?,?)',
+                                     events)
+            except sqlite3.Error as e:
+                print('ERROR: {} statistic events lost: {}'.format(
+                      len(events), e))
+
+
+def summary_days(conn):
+    # Returns {date: [sessions, completed, {hour: sessions}]}
+    # A session is completed if an applause video resp. the photo has been
+    # played before the buzzer is pressed again:
+    days = {}
+    session = None
+    for ts, kind, name in conn.execute(
+            'SELECT ts, kind, name FROM events '
+            'WHERE kind IN (?, ?) ORDER BY ts',
+            (EVENT_SESSION, EVENT_PLAY)):
+        if kind == EVENT_SESSION:
+            start = datetime.datetime.fromtimestamp(ts)
+            session = days.setdefault(start.date(), [0, 0, {}])
+            session[0] += 1
+            session[2][start.hour] = session[2].get(start.hour, 0) + 1
+        elif session is not None and name in [ROLE_APPL, ROLE_PHOTO]:
+            session[1] += 1
+            session = None
+    return days
+
+
+def summary_clips(conn):
+    # Returns {clip: [plays, loads, {return code: loads}]}
+    clips = {}
+    for kind, clip, code, count in conn.execute(
+            'SELECT kind, clip, code, COUNT(*) FROM events '
+            'WHERE kind IN (?, ?) GROUP BY kind, clip, code',
+            (EVENT_PLAY, EVENT_LOAD)):
+        entry = clips.setdefault(clip, [0, 0, {}])
+        if kind == EVENT_PLAY:
+            entry[0] += count
+        else:
+            entry[1] += count
+            entry[2][code] = entry[2].get(code, 0) + count
+    return clips
+
+
+def print_days(conn):
+    days = summary_days(conn)
+    print('date        sessions  completed    rate')
+    for date in sorted(days):
+        sessions, completed, hours = days[date]
+        print('{}  {:8d}  {:9d}  {:5.1f}%'.format(
+              date, sessions, completed, 100 * completed / sessions))
+        for hour in sorted(hours):
+            print('  {:02d}:00-{:02d}:59 {:8d}'.format(hour, hour,
+                                                     hours[hour]))
+
+
+def print_clips(conn):
+    # load_omxplayer() return codes:
+    # 1: omxplayer couldn't be started, 2: duration unknown,
+    # 3: instance still running
+    clips = summary_clips(conn)
+    print('plays  loads  err1  err2  err3  clip')
+    for clip in sorted(clips, key=str):
+        plays, loads, codes = clips[clip]
+        print('{:5d}  {:5d}  {:4d}  {:4d}  {:4d}  {}'.format(
+              plays, loads, codes.get(1, 0), codes.get(2, 0),
+              codes.get(3, 0), clip))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                 description='Summaries of the photomat.py statistics')
+    parser.add_argument('--db', default=STATS_DBFILE,
+                        help='statistics database (default: %(default)s)')
+    parser.add_argument('summary', nargs='?', default='days',
+                        choices=['days', 'clips'],
+                        help='sessions per day and hour resp. '
+                             'plays and load errors per clip')
+    args = parser.parse_args()
+    if not os.path.isfile(args.db):
+        print('ERROR: statistics database "{}" not found'.format(args.db))
+        return 1
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.summary == 'days':
+            print_days(conn)
+        else:
+            print_clips(conn)
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+#EOF